@@ -0,0 +1,37 @@
+# db_lock.py
+import fcntl, os, time
+from contextlib import contextmanager
+from pathlib import Path
+
+LOCK_TIMEOUT = 5.0       # seconds to wait for the lock before giving up
+LOCK_RETRY = 0.025       # seconds between attempts
+
+
+@contextmanager
+def db_lock(path: Path):
+    """
+    Cross-process lock around writes to `path`: flock(2) on `<path>.lock`. The kernel
+    releases it when the owner exits, so a crashed owner can't leave it held and there
+    is no takeover to race on; the file stays in place and names the last owner's PID.
+    Blocking: call from a worker thread, not from the event loop.
+    """
+    lock = path.with_suffix(path.suffix + ".lock")
+    fd = os.open(lock, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        deadline = time.monotonic() + LOCK_TIMEOUT
+        while True:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                if time.monotonic() >= deadline:
+                    raise TimeoutError(f"Timed out waiting for {lock}")
+                time.sleep(LOCK_RETRY)
+        try:
+            os.ftruncate(fd, 0)
+            os.pwrite(fd, str(os.getpid()).encode(), 0)
+            yield
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+    finally:
+        os.close(fd)
@@ -1,35 +1,441 @@
 # listener_worker.py
-import asyncio, json, traceback, os
+import asyncio, glob, hashlib, io, tempfile, traceback, os
+from array import array
 from pathlib import Path
 from datetime import datetime
-from typing import Dict, Tuple, Set
+from typing import Dict, List, Tuple, Set
 
-from telethon import TelegramClient, events
+import orjson
+import zstandard
+from telethon import TelegramClient, events, types, utils
+from telethon.errors import RPCError
 from telethon.sessions import StringSession
 
 
 DATA_DIR = Path(os.getenv("DATA_DIR", "/data")).resolve()
 DATA_DIR.mkdir(parents=True, exist_ok=True)
 
+# Captured messages wait in a staging file (see STAGING_DIR) and are written to the data
+# file and index in batches (one copy + fsync each per batch): a batch is flushed once
+# it holds FLUSH_MAX_BATCH records or its oldest record is FLUSH_INTERVAL seconds old,
+# and on listener shutdown.
+FLUSH_INTERVAL = float(os.getenv("FLUSH_INTERVAL", "2"))
+FLUSH_MAX_BATCH = int(os.getenv("FLUSH_MAX_BATCH", "50"))
 
-def _atomic_write_json(path: Path, data: Dict | list):
-    """Write JSON atomically to avoid partial files on restarts."""
+# Once data_<phone>.jsonl reaches ROTATE_BYTES it becomes data_<phone>.<n>.jsonl.zst
+# (n = 1, 2, ...) and a fresh file is started; the .idx file spans all segments.
+ROTATE_BYTES = int(os.getenv("ROTATE_BYTES", str(64 * 1024 * 1024)))
+ROTATE_ZSTD_LEVEL = 3
+
+# Handlers append records to a RAM-backed (tmpfs) staging file per phone; the flusher
+# moves each batch's new bytes into the persistent data file with sendfile(2). The
+# default directory is keyed by DATA_DIR so instances with different data dirs never
+# recover each other's records.
+STAGING_DIR = Path(os.getenv("STAGING_DIR") or os.path.join(
+    "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir(),
+    "telegram_listener_" + hashlib.sha1(str(DATA_DIR).encode()).hexdigest()[:12]))
+STAGING_DIR.mkdir(parents=True, exist_ok=True)
+
+# One queue + flusher task serve every listener in the process; created on first use
+FLUSH_QUEUE: asyncio.Queue | None = None   # (phone, key) per record; (phone, future) = listener closed
+_flush_full: asyncio.Event | None = None   # set once FLUSH_MAX_BATCH items are pending
+_flusher_task: asyncio.Task | None = None
+_SINKS: Dict[str, tuple] = {}              # phone -> (data fd, index fd), flusher-owned
+_STAGING: Dict[str, "_Staging"] = {}       # phone -> staging file shared by its listeners
+_STAGING_LOCK = asyncio.Lock()             # serializes opening (and recovering) staging files
+
+
+class _Staging:
+    """
+    A phone's staging file, shared by its listeners. Each batch the flusher renames the
+    file aside (with the keys of the records it holds) and starts a fresh one, so copied
+    bytes never pile up in RAM; set-aside files are deleted once stored.
+    """
+    __slots__ = ("phone", "path", "fd", "gen", "keys", "pending", "users")
+
+    def __init__(self, phone: str):
+        self.phone = phone
+        self.path = STAGING_DIR / f"data_{phone}.jsonl"
+        self.fd = os.open(self.path, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o600)
+        self.gen = 0        # number of the last set-aside file
+        self.keys = []      # keys of the records in the current file
+        self.pending = []   # set-aside (fd, path, keys) not stored yet, oldest first
+        self.users = 0      # listeners currently appending
+
+    def swap(self):
+        """Set the current file aside for the flusher and continue in a fresh one (on the loop)."""
+        held = STAGING_DIR / f"data_{self.phone}.{self.gen + 1}.jsonl"
+        os.rename(self.path, held)
+        try:
+            fd = os.open(self.path, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o600)
+        except OSError:
+            os.rename(held, self.path)
+            raise
+        self.gen += 1
+        self.pending.append((self.fd, held, self.keys))
+        self.fd = fd
+        self.keys = []
+
+    def close(self):
+        os.close(self.fd)
+        self.path.unlink(missing_ok=True)
+
+
+def _fsync_dir(path: Path):
+    fd = os.open(path, os.O_RDONLY | getattr(os, "O_DIRECTORY", 0))
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _write_all(fd: int, data):
+    """os.write all of `data` to a raw descriptor, finishing any short write."""
+    view = memoryview(data).cast("B")
+    while view:
+        view = view[os.write(fd, view):]
+
+
+def _copy_range(src_fd: int, dst_fd: int, offset: int, count: int):
+    """Write src[offset:offset + count] at dst's position with sendfile(2) (user-space copy if unsupported)."""
+    while count > 0:
+        try:
+            n = os.sendfile(dst_fd, src_fd, offset, count)
+        except OSError:
+            chunk = os.pread(src_fd, min(count, 1 << 20), offset)
+            _write_all(dst_fd, chunk)
+            n = len(chunk)
+        if n == 0:
+            break  # source shorter than expected
+        offset += n
+        count -= n
+
+
+def atomic_write_bytes(path: Path, payload: bytes):
+    """
+    Replace `path` via a same-directory tmp file + rename. The tmp file is fsynced
+    before the rename and the directory after it, so the new content survives power loss.
+    """
     tmp = path.with_suffix(path.suffix + ".tmp")
-    tmp.write_text(json.dumps(data, ensure_ascii=False, indent=2), encoding="utf-8")
-    tmp.replace(path)
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        _write_all(fd, payload)
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    os.replace(tmp, path)
+    _fsync_dir(path.parent)
+
+
+def _migrate_legacy_json(phone: str):
+    """Convert an old data_<phone>.json array into data_<phone>.jsonl (one-time)."""
+    legacy = DATA_DIR / f"data_{phone}.json"
+    data_file = DATA_DIR / f"data_{phone}.jsonl"
+    if not legacy.exists() or data_file.exists():
+        return
+    records = orjson.loads(legacy.read_bytes()) or []
+    atomic_write_bytes(data_file, b"".join(orjson.dumps(r) + b"\n" for r in records))
+    legacy.unlink()
+
+
+def migrate_legacy_files():
+    """Migrate every phone's data_<phone>.json; run at startup, before anything reads the data."""
+    for legacy in DATA_DIR.glob("data_*.json"):
+        phone = legacy.name[len("data_"):-len(".json")]
+        try:
+            _migrate_legacy_json(phone)
+        except Exception as e:
+            print(f"[{phone}] ⚠️ Failed migrating legacy data file: {e}", flush=True)
+
+
+def _segments(phone: str) -> Dict[int, Path]:
+    """Rotated segments by number; a raw .jsonl segment is one whose compression was interrupted."""
+    prefix = f"data_{phone}."
+    found: Dict[int, Path] = {}
+    for path in DATA_DIR.glob(f"{glob.escape(prefix)}*.jsonl*"):  # phone comes from requests
+        num, _, ext = path.name[len(prefix):].partition(".")
+        if not num.isdigit() or ext not in ("jsonl", "jsonl.zst"):
+            continue
+        n = int(num)
+        if n not in found or ext == "jsonl.zst":
+            found[n] = path
+    return found
+
+
+def segment_paths(phone: str) -> List[Path]:
+    """Rotated segments of a phone's history, oldest first (excludes the live data file)."""
+    found = _segments(phone)
+    return [found[n] for n in sorted(found)]
+
+
+def open_segment(path: Path):
+    """Open a data segment for binary reading, decompressing .zst segments on the fly."""
+    if path.suffix == ".zst":
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(path.open("rb")))
+    return path.open("rb")
+
+
+def _compress_segment(raw: Path):
+    zst = raw.with_name(raw.name + ".zst")
+    tmp = zst.with_name(zst.name + ".tmp")
+    with raw.open("rb") as src, tmp.open("wb") as dst:
+        zstandard.ZstdCompressor(level=ROTATE_ZSTD_LEVEL).copy_stream(src, dst)
+        dst.flush()
+        os.fsync(dst.fileno())
+    os.replace(tmp, zst)
+    raw.unlink()
+    _fsync_dir(DATA_DIR)
+
+
+def _rotate(phone: str):
+    """Turn the live data file into the next compressed segment; runs in a worker thread."""
+    found = _segments(phone)
+    raw = DATA_DIR / f"data_{phone}.{max(found, default=0) + 1}.jsonl"
+    os.replace(DATA_DIR / f"data_{phone}.jsonl", raw)
+    _fsync_dir(DATA_DIR)
+    for path in [*found.values(), raw]:
+        if path.suffix == ".jsonl":
+            _compress_segment(path)
+
+
+# A failing handler logs a full traceback for its 1st error and every Nth after that
+HANDLER_TRACEBACK_EVERY = 100
+
+# One stored message: {"timestamp", "text", "chat_id", "message_id"} + newline. The schema
+# is fixed, so the line is formatted directly; only the text needs real JSON escaping.
+_RECORD = b'{"timestamp":"%s","text":%s,"chat_id":%d,"message_id":%d}\n'
+
+
+def _fmt_ts(d: datetime) -> str:
+    """Naive ISO timestamp of a Telegram date (always UTC, whole seconds) without copying it."""
+    return d.strftime("%Y-%m-%dT%H:%M:%S")
+
+
+def _scan_seen(paths: List[Path]) -> Set[Tuple[int, int]]:
+    """Build the (chat_id, message_id) de-dup set by parsing every record of the given files."""
+    seen: Set[Tuple[int, int]] = set()
+    for path in paths:
+        with open_segment(path) as f:
+            for line in f:
+                try:
+                    r = orjson.loads(line)
+                except ValueError:
+                    continue  # blank or torn line
+                cid = r.get("chat_id")
+                mid = r.get("message_id")
+                if cid is not None and mid is not None:
+                    seen.add((int(cid), int(mid)))
+    return seen
+
+
+def _pack_keys(keys) -> array:
+    """Flatten (chat_id, message_id) pairs into int64s: cid, mid, cid, mid, ..."""
+    arr = array("q")
+    for cid, mid in keys:
+        arr.append(cid)
+        arr.append(mid)
+    return arr
+
+
+def _load_seen(phone: str) -> Set[Tuple[int, int]]:
+    """
+    Load the de-dup set from the packed index (data_<phone>.idx), falling back to
+    a full scan of all segments and the live file when the index is missing or damaged.
+    """
+    data_file = DATA_DIR / f"data_{phone}.jsonl"
+    index_file = DATA_DIR / f"data_{phone}.idx"
+    paths = segment_paths(phone) + ([data_file] if data_file.exists() else [])
+    if not paths:
+        return set()
+    if index_file.exists():
+        raw = index_file.read_bytes()
+        if len(raw) % 16 == 0:
+            arr = array("q")
+            arr.frombytes(raw)
+            return set(zip(arr[0::2], arr[1::2]))
+    seen = _scan_seen(paths)
+    atomic_write_bytes(index_file, _pack_keys(seen).tobytes())
+    return seen
+
+
+def _open_sink(phone: str) -> tuple:
+    """Open a phone's data file (positioned at its end) and index file for appending."""
+    data_file = DATA_DIR / f"data_{phone}.jsonl"
+    created = not data_file.exists()
+    # Not O_APPEND: sendfile(2) rejects append-mode targets. Writers never overlap
+    # (the flusher, or staging recovery before the phone has a sink).
+    data_fd = os.open(data_file, os.O_RDWR | os.O_CREAT, 0o644)
+    size = os.lseek(data_fd, 0, os.SEEK_END)
+    if size and os.pread(data_fd, 1, size - 1) != b"\n":
+        os.write(data_fd, b"\n")  # terminate a line torn by a crash
+    index_fd = os.open(DATA_DIR / f"data_{phone}.idx", os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    if created:
+        _fsync_dir(DATA_DIR)  # make the new file's directory entry durable too
+    return data_fd, index_fd
+
+
+def _staged_paths(phone: str) -> List[Path]:
+    """A phone's set-aside staging files, oldest first, then its current one."""
+    prefix = f"data_{phone}."
+    held = {}
+    for path in STAGING_DIR.glob(f"{glob.escape(prefix)}*.jsonl"):
+        num = path.name[len(prefix):-len(".jsonl")]
+        if num.isdigit():
+            held[int(num)] = path
+    return [held[n] for n in sorted(held)] + [STAGING_DIR / f"data_{phone}.jsonl"]
+
+
+def _open_staging(phone: str, seen: Set[Tuple[int, int]]) -> Tuple[_Staging, int]:
+    """
+    Open a phone's staging file. Records left in staging files by a process that died
+    before flushing them are appended to the data file first (skipping any already
+    stored) and those files are removed. Returns (staging, recovered count); runs in a worker thread.
+    """
+    paths = _staged_paths(phone)
+    lines, keys = [], []
+    stored = 0  # leading lines found already in the data file
+    for path in paths:
+        try:
+            raw = path.read_bytes()
+        except FileNotFoundError:
+            continue
+        for line in raw.splitlines(keepends=True):
+            try:
+                r = orjson.loads(line)
+                key = (int(r["chat_id"]), int(r["message_id"]))
+            except (ValueError, KeyError, TypeError):
+                continue  # torn line
+            if line.endswith(b"\n") and key not in seen:
+                seen.add(key)
+                lines.append(line)
+                keys.append(key)
+    if lines:
+        data_fd, index_fd = _open_sink(phone)
+        try:
+            # Dying between storing staged records and indexing them leaves them at the
+            # end of the data file: index those without appending them a second time
+            size = os.lseek(data_fd, 0, os.SEEK_END)
+            n = min(size, sum(map(len, lines)))
+            tail = os.pread(data_fd, n, size - n)
+            stored = next((k for k in range(len(lines), 0, -1)
+                           if tail.endswith(b"".join(lines[:k]))), 0)
+            if stored < len(lines):
+                _write_all(data_fd, b"".join(lines[stored:]))
+                os.fsync(data_fd)
+            _write_all(index_fd, _pack_keys(keys))
+            os.fsync(index_fd)
+        finally:
+            os.close(data_fd)
+            os.close(index_fd)
+    for path in paths:
+        path.unlink(missing_ok=True)
+    return _Staging(phone), len(lines) - stored
+
+
+def _write_batches(stages: List[_Staging]):
+    """
+    For each set-aside staging file, sendfile its bytes into the phone's data file and
+    append its keys to the index (both fsynced), then delete it. A file that fails is
+    rolled back out of the data file and kept for the next batch; runs in a worker thread.
+    """
+    for stage in stages:
+        phone = stage.phone
+        while stage.pending:
+            sink = _SINKS.get(phone)
+            if sink is None:
+                sink = _SINKS[phone] = _open_sink(phone)
+            fd, path, keys = stage.pending[0]
+            end = os.lseek(sink[0], 0, os.SEEK_END)
+            index_end = os.fstat(sink[1]).st_size
+            try:
+                _copy_range(fd, sink[0], 0, os.fstat(fd).st_size)
+                os.fsync(sink[0])
+                _write_all(sink[1], _pack_keys(keys))
+                os.fsync(sink[1])  # an index behind the data would let stored messages in again
+            except BaseException:
+                os.ftruncate(sink[0], end)
+                os.lseek(sink[0], end, os.SEEK_SET)
+                os.ftruncate(sink[1], index_end)
+                raise
+            stage.pending.pop(0)
+            os.close(fd)
+            path.unlink(missing_ok=True)
+            if os.fstat(sink[0]).st_size >= ROTATE_BYTES:
+                for fd in _SINKS.pop(phone):
+                    os.close(fd)
+                _rotate(phone)
+
+
+async def _flusher():
+    """Drain FLUSH_QUEUE for all phones: one data + index write (each fsynced) per phone per batch."""
+    while True:
+        items = [await FLUSH_QUEUE.get()]
+        if not isinstance(items[0][1], asyncio.Future):
+            # Hold the batch open until it fills up or FLUSH_INTERVAL elapses
+            try:
+                await asyncio.wait_for(_flush_full.wait(), FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+        _flush_full.clear()
+        while True:
+            try:
+                items.append(FLUSH_QUEUE.get_nowait())
+            except asyncio.QueueEmpty:
+                break
+
+        closed = [val for _, val in items if isinstance(val, asyncio.Future)]
+        try:
+            for phone, val in items:
+                if not isinstance(val, asyncio.Future):
+                    _STAGING[phone].keys.append(val)
+            # On the loop, so no handler appends meanwhile: set aside what was staged so far
+            stages = []
+            for stage in _STAGING.values():
+                if stage.keys:
+                    stage.swap()
+                if stage.pending:
+                    stages.append(stage)
+            await asyncio.to_thread(_write_batches, stages)
+
+            # Release staging files no listener uses any more, along with their sinks
+            for phone, stage in list(_STAGING.items()):
+                if not stage.users and not stage.pending and not stage.keys:
+                    del _STAGING[phone]
+                    stage.close()
+            for phone in [p for p in _SINKS if p not in _STAGING]:
+                for fd in _SINKS.pop(phone):
+                    os.close(fd)
+        except Exception as e:
+            print("⚠️ Flusher error:", e, traceback.format_exc(), flush=True)
+        finally:
+            for fut in closed:
+                if not fut.done():
+                    fut.set_result(None)
+
+
+def _ensure_flusher() -> asyncio.Queue:
+    global FLUSH_QUEUE, _flush_full, _flusher_task
+    if _flusher_task is None or _flusher_task.done():
+        FLUSH_QUEUE = asyncio.Queue()
+        _flush_full = asyncio.Event()
+        _flusher_task = asyncio.create_task(_flusher())
+    return FLUSH_QUEUE
 
 
 async def start_user_listener(phone: str, api_id: int, api_hash: str, session_string: str, groups):
     """
     Start a dedicated listener for one user.
     - Uses StringSession correctly
-    - Resolves provided group IDs against the user's dialogs to obtain full entities
-    - Appends every new message to /DATA_DIR/data_<phone>.json (atomic), with de-duplication
+    - Resolves provided group IDs to input entities (chats/channels only; dialogs as fallback)
+    - Appends every new message to /DATA_DIR/data_<phone>.jsonl (one JSON record per line), with de-duplication;
+      full files are rotated into zstd-compressed segments
     """
     def log(*a):
         print(f"[{phone}]", *a, flush=True)
 
     client: TelegramClient | None = None
+    queue: asyncio.Queue | None = None  # shared flush queue, once this listener captures
+    stage: _Staging | None = None
     try:
         # 1) Build client from StringSession
         client = TelegramClient(StringSession(session_string), int(api_id), str(api_hash))
@@ -51,41 +457,51 @@ async def start_user_listener(phone: str, api_id: int, api_hash: str, session_st
             except Exception:
                 log(f"⚠️ Skipping non-integer group id: {g}")
 
-        # 4) Fetch all dialogs once and build a map id -> entity (has access_hash)
-        dialogs = await client.get_dialogs(limit=None)
-        by_id = {}
-        for d in dialogs:
-            ent = getattr(d, "entity", None)
-            if ent is not None and hasattr(ent, "id"):
-                by_id[getattr(ent, "id")] = ent
-
+        # 4) Resolve each group id with get_input_entity. Unmarked ids (as in entity.id)
+        #    are looked up as channels/supergroups, marked ids (-123 chat, -100123 channel)
+        #    as what they name; a StringSession caches no entities, so this costs one
+        #    request per id. Ids that fail are matched against the groups in the recent
+        #    dialogs, and only then in the full dialog list.
         resolved = []
+        missing = []
         for gid in norm_ids:
-            ent = by_id.get(gid)
-            if ent is not None:
-                resolved.append(ent)
+            try:
+                ent = await client.get_input_entity(types.PeerChannel(gid) if gid > 0 else gid)
+            except (ValueError, RPCError):
+                missing.append(gid)
+                continue
+            resolved.append(ent)
+            log(f"🧩 Resolved group {gid} -> {type(ent).__name__}")
+
+        for limit in (200, None):
+            if not missing:
+                break
+            by_id = {}
+            for d in await client.get_dialogs(limit=limit):
+                ent = d.entity
+                if isinstance(ent, (types.Chat, types.Channel)):
+                    by_id[ent.id] = by_id[utils.get_peer_id(ent)] = ent
+            still = []
+            for gid in missing:
+                ent = by_id.get(gid)
+                if ent is None:
+                    still.append(gid)
+                    continue
+                resolved.append(utils.get_input_peer(ent))
                 log(f"🧩 Resolved group {gid} -> {type(ent).__name__}")
-            else:
-                log(f"⚠️ Could not resolve group {gid} from dialogs cache. "
-                    f"Are you a member of this group on this account?")
+            missing = still
+        for gid in missing:
+            log(f"⚠️ Could not resolve group {gid} from dialogs cache. "
+                f"Are you a member of this group on this account?")
 
-        data_file = DATA_DIR / f"data_{phone}.json"
-        # Load existing data & build a quick de-dup set
-        existing: list = []
+        # Load the de-dup set from the packed index (rebuilt from the data files if needed)
         seen: Set[Tuple[int, int]] = set()  # (chat_id, message_id)
-        if data_file.exists():
-            try:
-                existing = json.loads(data_file.read_text(encoding="utf-8")) or []
-                for r in existing:
-                    cid = r.get("chat_id")
-                    mid = r.get("message_id")
-                    if cid is not None and mid is not None:
-                        seen.add((int(cid), int(mid)))
-                log(f"📦 Loaded {len(existing)} existing messages.")
-            except Exception as e:
-                log(f"⚠️ Failed reading existing data file: {e}")
-
-        collected = existing  # alias
+        try:
+            seen = await asyncio.to_thread(_load_seen, phone)
+            if seen:
+                log(f"📦 Loaded {len(seen)} existing messages.")
+        except Exception as e:
+            log(f"⚠️ Failed reading existing data file: {e}")
 
         if not resolved:
             log("⚠️ No valid groups resolved; listener will idle (no handler attached).")
@@ -93,11 +509,27 @@ async def start_user_listener(phone: str, api_id: int, api_hash: str, session_st
             await client.run_until_disconnected()
             return
 
+        async with _STAGING_LOCK:
+            stage = _STAGING.get(phone)
+            if stage is None:
+                stage, recovered = await asyncio.to_thread(_open_staging, phone, seen)
+                _STAGING[phone] = stage
+                if recovered:
+                    log(f"♻️ Recovered {recovered} unflushed messages.")
+            stage.users += 1
+
         log(f"👂 Listening to {len(resolved)} chat(s).")
-        lock = asyncio.Lock()  # serialize file writes
+        queue = _ensure_flusher()
+        # Filter in the handler with an O(1) lookup on marked ids (-100... for channels),
+        # the same form as event.chat_id, instead of Telethon's per-update chats filter
+        chat_ids = frozenset(utils.get_peer_id(ent) for ent in resolved)
+        errors = 0  # handler failures so far; only some get a full traceback
 
-        @client.on(events.NewMessage(chats=resolved))
+        @client.on(events.NewMessage())
         async def handler(event):
+            nonlocal errors
+            if event.chat_id not in chat_ids:
+                return
             try:
                 msg_text = event.raw_text or ""
                 cid = int(event.chat_id)
@@ -106,22 +538,28 @@ async def start_user_listener(phone: str, api_id: int, api_hash: str, session_st
                 if key in seen:
                     return  # de-dup
 
-                rec = {
-                    "timestamp": event.date.replace(tzinfo=None).isoformat(),
-                    "text": msg_text,
-                    "chat_id": cid,
-                    "message_id": mid,
-                }
+                line = _RECORD % (_fmt_ts(event.date).encode(), orjson.dumps(msg_text), cid, mid)
 
-                async with lock:
-                    collected.append(rec)
-                    seen.add(key)
-                    _atomic_write_json(data_file, collected)
+                fd = stage.fd
+                size = os.fstat(fd).st_size
+                try:
+                    _write_all(fd, line)  # RAM-backed; reaches disk on the next flush
+                except BaseException:
+                    os.ftruncate(fd, size)  # drop a partial line; the message stays unseen
+                    raise
+                seen.add(key)
+                queue.put_nowait((phone, key))
+                if queue.qsize() >= FLUSH_MAX_BATCH:
+                    _flush_full.set()
 
                 log(f"💾 Captured msg #{mid} from chat {cid}")
 
             except Exception as e:
-                log("Handler error:", e, traceback.format_exc())
+                if errors % HANDLER_TRACEBACK_EVERY == 0:
+                    log("Handler error:", e, traceback.format_exc())
+                else:
+                    log("Handler error:", type(e).__name__, e)
+                errors += 1
 
         await client.run_until_disconnected()
 
@@ -133,6 +571,16 @@ async def start_user_listener(phone: str, api_id: int, api_hash: str, session_st
     finally:
         if client:
             try:
-                await client.disconnect()
+                await client.disconnect()  # no handler runs after this
             except Exception:
                 pass
+        if stage is not None:
+            stage.users -= 1
+            if queue is None:
+                queue = _ensure_flusher()  # let the flusher release the staging file
+            # Wait until the shared flusher has written everything we staged; don't
+            # outlive the flusher itself (e.g. when the loop is shutting down)
+            closed = asyncio.get_running_loop().create_future()
+            queue.put_nowait((phone, closed))
+            _flush_full.set()
+            await asyncio.wait({closed, _flusher_task}, return_when=asyncio.FIRST_COMPLETED)
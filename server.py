@@ -1,16 +1,20 @@
 # server.py
 # server.py
 
-import asyncio, json, os
+import asyncio, os
 from pathlib import Path
 from typing import Dict, List, Union
 
+import orjson
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import Response, StreamingResponse
 from pydantic import BaseModel
 from telethon import TelegramClient
 from telethon.sessions import StringSession
 
-from listener_worker import start_user_listener
+from db_lock import db_lock
+from listener_worker import (atomic_write_bytes, migrate_legacy_files, open_segment, segment_paths,
+                             start_user_listener)
 
 app = FastAPI(title="Telegram Listener Service")
 
@@ -19,23 +23,108 @@ DATA_DIR = Path(os.getenv("DATA_DIR", "/data")).resolve()
 DATA_DIR.mkdir(parents=True, exist_ok=True)
 DB_FILE = DATA_DIR / "database.json"  # { phone: {api_id, api_hash, session_string, groups: []} }
 
+DB_SAVE_DELAY = float(os.getenv("DB_SAVE_DELAY", "0.5"))  # debounce for database.json writes
+DB_RETRY_MAX = 30.0       # longest back-off between failed database.json writes
+DB_CLOSE_ATTEMPTS = 3     # final write attempts on shutdown before giving up
+STREAM_CHUNK = 64 * 1024  # read size when streaming message files
+
 LISTENERS: Dict[str, asyncio.Task] = {}     # in-memory running tasks
 PENDING: Dict[str, TelegramClient] = {}     # pending login clients (awaiting code)
 
+DB: dict = {}                 # in-memory copy of database.json, loaded once at startup
+DB_LOCK = asyncio.Lock()      # guards DB mutations
+DB_WRITE_LOCK = asyncio.Lock()  # one database.json write at a time
+DB_DIRTY = asyncio.Event()    # set when DB has changes not yet written to disk
+_db_flusher_task: asyncio.Task | None = None
+_db_load_error: Exception | None = None  # set if database.json exists but couldn't be read
+
 
 def load_db() -> dict:
+    """database.json's content ({} if there is none); raises if it can't be read or parsed."""
     if DB_FILE.exists():
-        try:
-            return json.loads(DB_FILE.read_text(encoding="utf-8"))
-        except Exception:
-            return {}
+        return orjson.loads(DB_FILE.read_bytes())
     return {}
 
 
-def save_db(data: dict):
-    tmp = DB_FILE.with_suffix(DB_FILE.suffix + ".tmp")
-    tmp.write_text(json.dumps(data, indent=2, ensure_ascii=False), encoding="utf-8")
-    tmp.replace(DB_FILE)
+def save_db(payload: bytes):
+    with db_lock(DB_FILE):  # also serializes against other service processes
+        atomic_write_bytes(DB_FILE, payload)
+
+
+async def _write_db():
+    """Snapshot DB under the lock and write it off the event loop."""
+    if _db_load_error is not None:
+        raise RuntimeError(f"database.json failed to load ({_db_load_error}); not overwriting it")
+    async with DB_WRITE_LOCK:
+        async with DB_LOCK:
+            DB_DIRTY.clear()
+            payload = orjson.dumps(DB, option=orjson.OPT_INDENT_2)
+        try:
+            await asyncio.to_thread(save_db, payload)
+        except BaseException:
+            DB_DIRTY.set()  # the snapshot never reached disk
+            raise
+
+
+async def db_flusher():
+    """
+    Persist DB after mutations; bursts within DB_SAVE_DELAY share one write.
+    Failed writes are retried with a doubling delay (up to DB_RETRY_MAX).
+    """
+    delay = DB_SAVE_DELAY
+    while True:
+        await DB_DIRTY.wait()
+        await asyncio.sleep(delay)
+        try:
+            await _write_db()
+            delay = DB_SAVE_DELAY
+        except Exception as e:
+            delay = min(max(delay * 2, 1.0), DB_RETRY_MAX)
+            print(f"⚠️ Failed writing database.json (retrying in {delay:g}s):", e, flush=True)
+
+
+@app.on_event("startup")
+async def open_db():
+    global _db_flusher_task, _db_load_error
+    try:
+        DB.update(await asyncio.to_thread(load_db))
+    except Exception as e:
+        # Starting empty is fine, but saving would wipe every stored session
+        _db_load_error = e
+        print("❌ Failed reading database.json; changes will NOT be saved until it is fixed:",
+              e, flush=True)
+    _db_flusher_task = asyncio.create_task(db_flusher())
+
+
+@app.on_event("startup")
+async def migrate_legacy_data():
+    # Before any request: /get_data only reads the JSONL files
+    await asyncio.to_thread(migrate_legacy_files)
+
+
+@app.on_event("shutdown")
+async def close_db():
+    try:
+        async with DB_WRITE_LOCK:
+            pass  # let a write the flusher has in flight finish
+        if not DB_DIRTY.is_set():
+            return  # nothing changed since the last write
+        if _db_load_error is not None:
+            print("⚠️ Discarding unsaved changes: database.json failed to load.", flush=True)
+            return
+        for attempt in range(1, DB_CLOSE_ATTEMPTS + 1):
+            try:
+                await _write_db()
+                break
+            except Exception as e:
+                print(f"⚠️ Failed writing database.json on shutdown "
+                      f"(attempt {attempt}/{DB_CLOSE_ATTEMPTS}):", e, flush=True)
+                if attempt == DB_CLOSE_ATTEMPTS:
+                    raise
+                await asyncio.sleep(1.0)
+    finally:
+        if _db_flusher_task is not None:
+            _db_flusher_task.cancel()
 
 
 # --------- Models ---------
@@ -87,11 +176,11 @@ async def session_init(req: SessionInitRequest):
     PENDING[req.phone] = client
 
     # Persist API credentials for this phone
-    db = load_db()
-    db.setdefault(req.phone, {})
-    db[req.phone]["api_id"] = req.api_id
-    db[req.phone]["api_hash"] = req.api_hash
-    save_db(db)
+    async with DB_LOCK:
+        conf = DB.setdefault(req.phone, {})
+        conf["api_id"] = req.api_id
+        conf["api_hash"] = req.api_hash
+        DB_DIRTY.set()
 
     return {"status": "code_sent"}
 
@@ -118,18 +207,16 @@ async def session_complete(req: SessionCompleteRequest):
     await client.disconnect()
     PENDING.pop(req.phone, None)
 
-    db = load_db()
-    db.setdefault(req.phone, {})
-    db[req.phone]["session_string"] = session_string
-    save_db(db)
+    async with DB_LOCK:
+        DB.setdefault(req.phone, {})["session_string"] = session_string
+        DB_DIRTY.set()
 
     return {"status": "ok"}
 
 
 @app.get("/session/status/{phone}")
-def session_status(phone: str):
-    db = load_db()
-    item = db.get(phone)
+async def session_status(phone: str):
+    item = DB.get(phone)
     has_session = bool(item and item.get("session_string"))
     return {"has_session": has_session}
 
@@ -137,10 +224,10 @@ def session_status(phone: str):
 @app.post("/session/logout/{phone}")
 async def session_logout(phone: str):
     """Delete stored server session; stop listener if running."""
-    db = load_db()
-    if phone in db:
-        db[phone].pop("session_string", None)
-        save_db(db)
+    async with DB_LOCK:
+        if phone in DB:
+            DB[phone].pop("session_string", None)
+            DB_DIRTY.set()
 
     task = LISTENERS.pop(phone, None)
     if task and not task.done():
@@ -155,10 +242,12 @@ async def start_listener(req: StartRequest):
     Start (or restart) a 24/7 listener for the server-owned session.
     If already running and groups changed, the listener is restarted.
     """
-    db = load_db()
-    conf = db.get(req.phone)
+    conf = DB.get(req.phone)
     if not conf or not conf.get("session_string"):
         raise HTTPException(400, "No server session. Complete /session/init and /session/complete first.")
+    # Read credentials now; conf is the live DB entry and may change while we await below
+    api_id, api_hash = int(conf["api_id"]), str(conf["api_hash"])
+    session_string = str(conf["session_string"])
 
     # Normalize groups to list of ints (Telethon uses ints for entity ids)
     norm_groups: List[int] = []
@@ -169,9 +258,10 @@ async def start_listener(req: StartRequest):
             pass
 
     # Persist selected groups
-    prior_groups = conf.get("groups", [])
-    conf["groups"] = norm_groups
-    save_db(db)
+    async with DB_LOCK:
+        prior_groups = conf.get("groups", [])
+        conf["groups"] = norm_groups
+        DB_DIRTY.set()
 
     # If a listener is running and groups didn't change, keep it
     t = LISTENERS.get(req.phone)
@@ -186,12 +276,11 @@ async def start_listener(req: StartRequest):
         except Exception:
             pass
 
-    loop = asyncio.get_event_loop()
-    task = loop.create_task(start_user_listener(
+    task = asyncio.create_task(start_user_listener(
         phone=req.phone,
-        api_id=int(conf["api_id"]),
-        api_hash=str(conf["api_hash"]),
-        session_string=str(conf["session_string"]),
+        api_id=api_id,
+        api_hash=api_hash,
+        session_string=session_string,
         groups=norm_groups,
     ))
     LISTENERS[req.phone] = task
@@ -213,12 +302,85 @@ async def stop_listener(phone: str):
     return {"status": "stopped"}
 
 
-@app.get("/get_data/{phone}")
-def get_data(phone: str):
-    data_file = DATA_DIR / f"data_{phone}.json"
-    if not data_file.exists():
-        return []
+@app.on_event("shutdown")
+async def stop_all_listeners():
+    """Cancel running listeners so each one flushes its buffered messages before exit."""
+    tasks = [t for t in LISTENERS.values() if not t.done()]
+    for t in tasks:
+        t.cancel()
+    if tasks:
+        await asyncio.wait(tasks, timeout=10)
+
+
+def _open_history(phone: str):
+    """
+    Open a phone's rotated segments and live data file up front, so rotation renaming
+    or compressing them mid-stream can't drop or repeat records. If the live file is
+    rotated while they are being opened, everything is reopened.
+    Returns (segment files oldest first, live file or None); runs in a worker thread.
+    """
+    data_file = DATA_DIR / f"data_{phone}.jsonl"
+    while True:
+        opened = []
+        try:
+            try:
+                live = data_file.open("rb")
+                opened.append(live)
+            except FileNotFoundError:
+                live = None
+            for path in segment_paths(phone):
+                opened.append(open_segment(path))
+            if live is None or os.stat(data_file).st_ino == os.fstat(live.fileno()).st_ino:
+                return (opened[1:] if live else opened), live
+        except FileNotFoundError:
+            pass  # a segment was compressed, or the live file rotated, while opening
+        except BaseException:
+            for f in opened:
+                f.close()
+            raise
+        for f in opened:
+            f.close()
+
+
+async def _iter_jsonl(f):
+    """
+    Yield the open file in STREAM_CHUNK pieces, reading off the event loop. Stops at the
+    last complete line present when streaming began, so a batch being appended
+    concurrently never shows up half-written.
+    """
+    remaining = os.fstat(f.fileno()).st_size
+    partial = b""  # bytes after the last newline seen so far
+    while remaining > 0:
+        chunk = await asyncio.to_thread(f.read, min(STREAM_CHUNK, remaining))
+        if not chunk:
+            break
+        remaining -= len(chunk)
+        chunk = partial + chunk
+        cut = chunk.rfind(b"\n") + 1
+        partial = chunk[cut:]
+        if cut:
+            yield chunk[:cut]
+
+
+async def _iter_history(segments: list, live):
+    """Rotated segments (decompressed) oldest first, then the live data file; closes them all."""
     try:
-        return json.loads(data_file.read_text(encoding="utf-8"))
-    except Exception:
-        return []
+        for f in segments:
+            while chunk := await asyncio.to_thread(f.read, STREAM_CHUNK):
+                yield chunk
+        if live is not None:
+            async for chunk in _iter_jsonl(live):
+                yield chunk
+    finally:
+        for f in [*segments, live]:
+            if f is not None:
+                await asyncio.to_thread(f.close)
+
+
+@app.get("/get_data/{phone}")
+async def get_data(phone: str):
+    """Captured messages as NDJSON (one JSON record per line), streamed from disk."""
+    segments, live = await asyncio.to_thread(_open_history, phone)
+    if not segments and live is None:
+        return Response(b"", media_type="application/x-ndjson")
+    return StreamingResponse(_iter_history(segments, live), media_type="application/x-ndjson")